@@ -5,39 +5,72 @@ Experiments in generating fractal shapes to an SVG file for use on a
 quilting machine or Cricut.
 """
 
-import itertools
 import math
 
+import numpy as np
+
+# Which side of a SidedSegment is owned.  These are 0 and 1, so that
+# `side ^ 1` is the other side, in scalars and in arrays.
+LEFT = 0
+RIGHT = 1
+
+# SVG paths are written in whole units of 1/PATH_SCALE.  That's the
+# same precision as writing them with three decimal places, but integers
+# are much faster to format than floats.
+PATH_SCALE = 1000
+
 
 class Elem:
     """
-    An XML element that knows how to serialize itself with str()
+    An XML element that knows how to write itself to a file
     """
     def __init__(self, name, attributes, *sub_elems):
         self.name = name
         self.attributes = attributes
         self.sub_elems = sub_elems
 
-    def format(self, indent=0):
-        spaces = "  " * indent
-        result = []
+    def write(self, f, indent=0):
+        """
+        Writes the element to a file.  Attribute values that are callable
+        return an iterable of strings, which are written one by one, so
+        big values never need to be in memory all at once.  Each write
+        calls them again, so an element can be written more than once.
+        All other values are formatted with %s.
+        """
         if indent == 0:
-            result.append('<?xml version="1.0"?>\n')
-        attrs = "".join(
-            ' %s="%s"' % (k.replace("_", "-"), v)
-            for k, v in self.attributes.items()
-        )
-        result.append("%s<%s%s>\n" % (spaces, self.name, attrs,))
-        for s in self.sub_elems:
-            result.append(s.format(indent=indent+1))
-        result.append("%s</%s>\n" % (spaces, self.name,))
-        return "".join(result)
+            f.write('<?xml version="1.0"?>\n')
+
+        # Walks the tree with a stack instead of recursing.  Each entry
+        # is (elem, None, depth) for an element to write, or
+        # (None, name, depth) for a closing tag to write once the
+        # element's sub-elements are done.
+        stack = [(self, None, indent)]
+        while stack:
+            elem, closing_name, depth = stack.pop()
+            spaces = "  " * depth
+            if elem is None:
+                f.write("%s</%s>\n" % (spaces, closing_name,))
+                continue
+            f.write("%s<%s" % (spaces, elem.name,))
+            for k, v in elem.attributes.items():
+                name = k.replace("_", "-")
+                if callable(v):
+                    f.write(' %s="' % (name,))
+                    f.writelines(v())
+                    f.write('"')
+                else:
+                    f.write(' %s="%s"' % (name, v,))
+            f.write(">\n")
+            stack.append((None, elem.name, depth))
+            stack.extend((s, None, depth + 1) for s in reversed(elem.sub_elems))
 
 
 class Point:
     """
     A two-dimensional point.  Also used as a vector, for now.
     """
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -59,30 +92,114 @@ class Point:
     def right(self, angle):
         return self.left(-angle)
 
-    def as_string_with_comma(self):
-        return "%6.3f,%6.3f" % (self.x, self.y)
-
 
 class LineSegment:
     """
     A line segment from one point to another.
     """
+    __slots__ = ("p1", "p2")
 
     def __init__(self, p1, p2):
         self.p1 = p1
         self.p2 = p2
 
 
+def frame_matrix(points, side):
+    """
+    Returns the matrix that maps the ends of a segment owning `side`,
+    as [p1.x, p1.y, p2.x, p2.y], to the positions of `points` (given
+    in the segment's frame), as [x0, y0, x1, y1, ...].
+    """
+    # Turns a vector 90 degrees toward the side, the same as
+    # Point.left(math.pi / 2) or Point.right(math.pi / 2).
+    sign = 1.0 if side == LEFT else -1.0
+    turn = sign * np.array([[0.0, 1.0], [-1.0, 0.0]])
+    eye = np.eye(2)
+    return np.vstack([
+        np.hstack([(1 - u) * eye - w * turn, u * eye + w * turn])
+        for (u, w) in points
+    ])
+
+
 class SidedSegment:
     """
     A line segment that owns the area to one side.
+
+    Subclasses say what one step of the fractal does to a segment, in
+    the segment's own frame.  A point (u, w) in that frame is at
+    p1 + u * (p2 - p1) + w * (p2 - p1 turned 90 degrees toward the side).
+    CORNERS are the points, in order, where the children meet between
+    p1 and p2, and FLIPPED says which children own the other side.
+    Because these are the same for every segment, each corner is a fixed
+    linear function of p1 and p2, and a step is one matrix product for
+    each side.
     """
+    __slots__ = ("p1", "p2", "side")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.BRANCHING = len(cls.FLIPPED)
+        # The matrices also pass p1 and p2 through, so that they give all
+        # of the points along the children, in order.
+        path = ((0.0, 0.0),) + tuple(cls.CORNERS) + ((1.0, 0.0),)
+        cls.MATRICES = {
+            side: frame_matrix(path, side).T
+            for side in (LEFT, RIGHT)
+        }
+        cls.FLIP = np.array(cls.FLIPPED, dtype=np.int8)
+
     def __init__(self, p1, p2, side):
-        assert side in ["left", "right"]
+        assert side in (LEFT, RIGHT)
         self.p1 = p1
         self.p2 = p2
         self.side = side
 
+    def as_arrays(self):
+        """
+        Returns this segment as a one-element (p1, p2, side) triple of
+        arrays, which is the form that step() works on.
+        """
+        return (
+            np.array([[self.p1.x, self.p1.y]], dtype=float),
+            np.array([[self.p2.x, self.p2.y]], dtype=float),
+            np.array([self.side], dtype=np.int8),
+        )
+
+    @classmethod
+    def step(cls, p1, p2, side, out):
+        """
+        Writes the children of the segments in (p1, p2, side) to the
+        `out` triple of arrays.  Any of the `out` arrays can be None if
+        the caller doesn't need it.
+        """
+        n = len(side)
+        ends = np.hstack([p1, p2])
+        points = np.empty((n, 2 * (cls.BRANCHING + 1)))
+        for s, matrix in cls.MATRICES.items():
+            mask = side == s
+            points[mask] = ends[mask] @ matrix
+        points = points.reshape(n, -1, 2)
+
+        # The children of each segment are next to each other, in order.
+        # The outputs are written through reshape(), which only gives a
+        # view, rather than a copy, for contiguous arrays.
+        assert all(a is None or a.flags.c_contiguous for a in out)
+        out_p1, out_p2, out_side = out
+        if out_p1 is not None:
+            out_p1.reshape(n, -1, 2)[:] = points[:, :-1]
+        if out_p2 is not None:
+            out_p2.reshape(n, -1, 2)[:] = points[:, 1:]
+        if out_side is not None:
+            out_side.reshape(n, -1)[:] = side[:, None] ^ cls.FLIP
+
+
+def segment_arrays(n):
+    """
+    Allocates an uninitialized (p1, p2, side) triple of arrays big
+    enough for n segments.
+    """
+    return np.empty((n, 2)), np.empty((n, 2)), np.empty(n, dtype=np.int8)
+
 
 class FourSquaresOnSide(SidedSegment):
     """
@@ -92,31 +209,9 @@ class FourSquaresOnSide(SidedSegment):
                     |      |
     --------        |      |
     """
-    def step(self):
-        if self.side == "left":
-            v_half = (self.p2 - self.p1) * 0.5
-            v_up = v_half.left(math.pi / 2)
-            p_a = self.p1 + v_up
-            p_b = p_a + v_half
-            p_c = self.p2 + v_up
-            return [
-                FourSquaresOnSide(self.p1, p_a, "right"),
-                FourSquaresOnSide(p_a, p_b, "left"),
-                FourSquaresOnSide(p_b, p_c, "left"),
-                FourSquaresOnSide(p_c, self.p2, "right")
-            ]
-        else:
-            v_half = (self.p2 - self.p1) * 0.5
-            v_down = v_half.right(math.pi / 2)
-            p_a = self.p1 + v_down
-            p_b = p_a + v_half
-            p_c = self.p2 + v_down
-            return [
-                FourSquaresOnSide(self.p1, p_a, "left"),
-                FourSquaresOnSide(p_a, p_b, "right"),
-                FourSquaresOnSide(p_b, p_c, "right"),
-                FourSquaresOnSide(p_c, self.p2, "left")
-            ]
+    __slots__ = ()
+    CORNERS = ((0.0, 0.5), (0.5, 0.5), (1.0, 0.5))
+    FLIPPED = (True, False, False, True)
 
 
 class TwoTrianglesOnSide(SidedSegment):
@@ -126,70 +221,77 @@ class TwoTrianglesOnSide(SidedSegment):
                   / \
     -------      /   \
     """
-    def step(self):
-        half = (self.p2 - self.p1) * 0.5
-        if self.side == "left":
-            up_half = half.left(math.pi / 2)
-            mid = self.p1 + half + up_half
-            return [
-                TwoTrianglesOnSide(self.p1, mid, "right"),
-                TwoTrianglesOnSide(mid, self.p2, "right")
-            ]
-        else:
-            down_half = half.right(math.pi / 2)
-            mid = self.p1 + half + down_half
-            return [
-                TwoTrianglesOnSide(self.p1, mid, "left"),
-                TwoTrianglesOnSide(mid, self.p2, "left")
-            ]
+    __slots__ = ()
+    CORNERS = ((0.5, 0.5),)
+    FLIPPED = (True, True)
+
 
 def fractal(elem, depth):
     """
-    Given a single element, returns the list of elements that replace it.
-    :param elem:
-    :param f:
-    :param depth:
-    :return:
+    Given a single element, returns the segments that replace it, as a
+    (p1, p2, side) triple of arrays.
     """
-    if depth == 0:
-        return [elem]
-    else:
-        sub_elems = elem.step()
-        return list(itertools.chain(*(fractal(e, depth - 1) for e in sub_elems)))
-
-
-def segments_to_points(segments):
+    # Each level is written into one of two preallocated buffers,
+    # alternating, rather than into new arrays.
+    cls = type(elem)
+    size = cls.BRANCHING ** depth
+    buffers = [segment_arrays(size), segment_arrays(size)]
+    segments = elem.as_arrays()
+    for level in range(depth):
+        count = len(segments[2]) * cls.BRANCHING
+        out = tuple(a[:count] for a in buffers[level % 2])
+        cls.step(*segments, out)
+        segments = out
+    return segments
+
+
+def fractal_points(elem, depth):
     """
-    Maps from a list of segments to a list of points.
+    Given a single element, returns the (N + 1, 2) array of points along
+    the path of the segments that replace it.
     """
-    # We assume that the ending point of one segment is the same
-    # as the starting point of the next segment.
-    assert all(a.p2 == b.p1 for (a, b) in itertools.pairwise(segments))
+    cls = type(elem)
+    points = np.empty((cls.BRANCHING ** depth + 1, 2))
 
     # The first point is the start point of the first segment
-    result = [segments[0].p1]
-    for s in segments:
-        result.append(s.p2)
-    return result
+    points[0] = elem.p1.x, elem.p1.y
+    if depth == 0:
+        points[1] = elem.p2.x, elem.p2.y
+        return points
+
+    # The last step only writes its end points, straight into `points`.
+    # step() makes the end of each segment the start of the next, so the
+    # start points would just be `points` again, shifted by one.
+    p1, p2, side = fractal(elem, depth - 1)
+    cls.step(p1, p2, side, (None, points[1:], None))
+    return points
 
 
-def points_to_stroke_d(points):
+def points_to_stroke_d(points, chunk_size=4096):
     """
-    Converts a sequence of points to the "d" attribute for an SVG stroke.
+    Converts an (N, 2) array of points to the "d" attribute for an SVG
+    stroke, in units of 1/PATH_SCALE, as a move to the first point
+    followed by relative lines, which are shorter to write.  Yields it in
+    pieces of up to chunk_size points each.
     """
-    parts = ["M", points[0].as_string_with_comma()]
-    for p in points:
-        parts.append("L")
-        parts.append(p.as_string_with_comma())
-    return " ".join(parts)
+    # Rounding before taking differences makes the deltas exact, so
+    # rounding doesn't add up along the path.
+    coords = np.rint(points * PATH_SCALE).astype(np.int64)
+    deltas = np.diff(coords, axis=0)
+    yield "M %d,%d" % tuple(coords[0].tolist())
+
+    # One big % with a format per point is much faster than formatting
+    # the points one at a time, and faster than np.char.mod or np.savetxt.
+    for start in range(0, len(deltas), chunk_size):
+        chunk = deltas[start:start+chunk_size]
+        fmt = " l %d,%d" * len(chunk)
+        yield fmt % tuple(chunk.ravel().tolist())
 
 
 def make_pattern():
     # elems = fractal(LineSegment(Point(25, 50), Point(75, 50)), left_triangle, 1)
-    init = TwoTrianglesOnSide(Point(0, 100), Point(100, 100), "left")
-    elems = fractal(init, 7)
-    points = segments_to_points(elems)
-    d = points_to_stroke_d(points)
+    init = TwoTrianglesOnSide(Point(0, 100), Point(100, 100), LEFT)
+    points = fractal_points(init, 7)
     doc = Elem(
         "svg",
         dict(
@@ -197,25 +299,24 @@ def make_pattern():
             version="1.1",
             width="200.000mm",
             height="200.000mm",
-            viewBox="0.000,0.000,100.000,100.000",
+            viewBox="0,0,%d,%d" % (100 * PATH_SCALE, 100 * PATH_SCALE),
         ),
         Elem(
             "path",
             dict(
                 stroke="#000000",
                 fill="none",
-                stroke_width="0.25",
+                stroke_width="%g" % (0.25 * PATH_SCALE),
                 stroke_linecap="round",
                 stroke_linejoin="round",
                 stroke_miterlimit="10.000",
-                d=d
+                d=lambda: points_to_stroke_d(points)
             )
         )
     )
-    svg = doc.format()
     file_name = "/Users/brianb/test.svg"
     with open(file_name, "w") as f:
-        f.write(svg)
+        doc.write(f)
     print("wrote", file_name)
 
 